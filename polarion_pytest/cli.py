@@ -4,10 +4,14 @@
 from __future__ import absolute_import, unicode_literals
 
 import argparse
+import copy
 import io
 import logging
+import multiprocessing
 import os
 import re
+import shutil
+import tempfile
 import textwrap
 
 from polarion_docstrings import polarion_fields as pf
@@ -22,6 +26,65 @@ logger = logging.getLogger(__name__)
 
 MANUAL_TESTS_FILE = 'cfme/tests/test_manual.py'
 
+_CDATA_RE = re.compile(r'<!\[CDATA\[(.+)\]\]>')
+_NEWLINES_RE = re.compile(r'(?: *\n)+')
+_STEP_NUM_RE = re.compile(r'[0-9]+[.)]? ?')
+_MULTI_SPACE_RE = re.compile(' +')
+_TITLE_PUNCT_RE = re.compile(r'[ :/\-()\[\]_]+')
+_NON_ALNUM_RE = re.compile('[^a-z0-9_]')
+
+_ENTITY_MAP = {
+    '&nbsp;': ' ',
+    '&gt;': '>',
+    '&lt;': '<',
+    '&quot;': '"',
+    '&amp;': '&',
+    '&#39;': '"',
+    '&#10;': '\n',
+    u'\xa0': u' ',
+}
+# HTML tags (with `<br>` captured) and entities, handled in single pass by `_replace_markup`
+_MARKUP_RE = re.compile('<(?:(br ?/?)|[^>]+)>|{}'.format(
+    '|'.join(re.escape(entity) for entity in _ENTITY_MAP)))
+
+# mapping of requirement IDs to requirement names
+_REQUIREMENTS_DB = {
+    req_id: req_name for req_name, req_ids in REQUIREMENTS_MAP.items() for req_id in req_ids}
+
+# preformatted numbers of steps, for steps with and without text
+_STEP_NUMS = tuple('{}. '.format(index) for index in range(100))
+_EMPTY_STEP_NUMS = tuple('{}.'.format(index) for index in range(100))
+
+_WRAPPER = textwrap.TextWrapper(width=70)
+_WRAPPER_60 = textwrap.TextWrapper(width=60)
+
+_NOT_WRAPPED_KEYS = {
+    'casecomponent',
+    'setup',
+    'teardown',
+    'description',
+    'testSteps',
+    'expectedResults',
+    'linkedWorkItems',
+}
+# fields with values that are wrapped by `_wrap_values`, together with info
+# whether the value needs to be sanitized (i.e. it's not one of predefined values)
+_WRAP_KEYS = tuple(
+    (key, key not in pf.VALID_VALUES)
+    for key in pf.POLARION_FIELDS if key not in _NOT_WRAPPED_KEYS)
+
+# fields that are part of the "Polarion" section of docstring, in output order
+_FORMAT_KEYS = tuple(sorted(set(pf.POLARION_FIELDS) - {
+    'caseautomation',
+    'caselevel',
+    'description',
+    'testSteps',
+    'expectedResults',
+    'work_item_id',
+}))
+_FORMAT_KEYS_AUTOMATED = tuple(
+    key for key in _FORMAT_KEYS if key not in pf.MANUAL_ONLY_FIELDS)
+
 
 class TestcasesException(Exception):
     pass
@@ -32,13 +95,16 @@ class TestsTransform(object):
     DEFAULT_DATA = {key: None for key in pf.REQUIRED_FIELDS}
 
     def __init__(self):
-        self.manual_tests_seen = []
+        self.manual_tests_seen = set()
+        self._polarion_data_cache = {}
+        self._default_docstrings = {}
+        self._automated_testcases = None
 
     @staticmethod
-    def _copy_string(string, to_string):
-        """Copies string to string representing changed file."""
+    def _copy_string(string, to_file):
+        """Copies string to file object representing changed file."""
         if string:
-            to_string.append(string)
+            to_file.write(string)
 
     @staticmethod
     def get_tier(polarion_data):
@@ -56,19 +122,17 @@ class TestsTransform(object):
             return None
         return '@pytest.mark.tier({})'.format(tier)
 
-    def append_tier(self, polarion_data, line):
-        tier_annotation = self.get_tier_annotation(polarion_data)
+    @staticmethod
+    def append_tier(tier_annotation, line, method_indent):
         if not tier_annotation:
             return line
-        method_indent = len(line) - len(line.lstrip(' '))
         return '{}{}\n{}'.format(method_indent * ' ', tier_annotation, line)
 
-    @staticmethod
-    def get_testcase_data(testcase_name, active_testcases):
-        try:
-            return active_testcases.get_by_name(testcase_name, automated=True)
-        except KeyError:
-            return None
+    def get_testcase_data(self, testcase_name, active_testcases):
+        # look up all automated testcases at once instead of searching for each test
+        if self._automated_testcases is None:
+            self._automated_testcases = active_testcases.get_automated_testcases()
+        return self._automated_testcases.get(testcase_name)
 
     @staticmethod
     def filter_testcase_fields(testcase_data):
@@ -87,8 +151,15 @@ class TestsTransform(object):
         return polarion_data
 
     def get_polarion_data(self, testcase_name, active_testcases):
-        testcase_data = self.get_testcase_data(testcase_name, active_testcases)
-        return self.filter_testcase_fields(testcase_data)
+        # the same test can be encountered several times (e.g. parametrized tests),
+        # callers modify the returned data so return a copy of the cached record
+        try:
+            polarion_data = self._polarion_data_cache[testcase_name]
+        except KeyError:
+            testcase_data = self.get_testcase_data(testcase_name, active_testcases)
+            polarion_data = self.filter_testcase_fields(testcase_data)
+            self._polarion_data_cache[testcase_name] = polarion_data
+        return copy.copy(polarion_data)
 
     @staticmethod
     def _format_steps(steps):
@@ -101,28 +172,30 @@ class TestsTransform(object):
         for index, step in enumerate(steps, 1):
             step = _sanitize_string(step).strip() if step else ''
 
-            numbered = re.match(r'[0-9]+[.)]? ?', step)
+            # the regex can match only when step starts with a digit
+            numbered = _STEP_NUM_RE.match(step) if step[:1].isdigit() else None
 
             if numbered:
                 step_num = ''
+            elif index >= len(_STEP_NUMS):
+                step_num = '{}. '.format(index) if step else '{}.'.format(index)
             elif step:
-                step_num = '{}. '.format(index)
+                step_num = _STEP_NUMS[index]
             else:
-                step_num = '{}.'.format(index)
+                step_num = _EMPTY_STEP_NUMS[index]
 
             # wrap line if too long
             steps = []
             if len(step) > 80:
-                steps = textwrap.wrap(step, width=60)
+                steps = _WRAPPER_60.wrap(step)
                 step = steps.pop(0)
 
-            step_str = '{}{}{}'.format(indent, step_num, step)
-            new_steps.append(step_str)
+            new_steps.append(indent + step_num + step)
 
             wrap_indent = len(step_num) if step_num else len(numbered.group(0))
-            wrap_indent = '{}{}'.format(indent, wrap_indent * ' ')
+            wrap_indent = indent + wrap_indent * ' '
             for val in steps:
-                new_steps.append('{}{}'.format(wrap_indent, val))
+                new_steps.append(wrap_indent + val)
 
         return new_steps
 
@@ -146,9 +219,9 @@ class TestsTransform(object):
 
     @staticmethod
     def _transform_polarion_data(polarion_data):
-        title = polarion_data.get('title', '')
+        title = polarion_data.get('title') or ''
         if 'test_' in title and len(title) <= 85:
-            del polarion_data['title']
+            polarion_data.pop('title', None)
 
         if polarion_data.get('linkedWorkItems'):
             new_linked = ', '.join(polarion_data.get('linkedWorkItems'))
@@ -171,56 +244,43 @@ class TestsTransform(object):
 
     @staticmethod
     def _wrap_values(polarion_data):
-        ommit_keys = {
-            'casecomponent',
-            'setup',
-            'teardown',
-            'description',
-            'testSteps',
-            'expectedResults',
-            'linkedWorkItems',
-        }
-
-        for key in set(polarion_data) - ommit_keys:
+        for key, needs_sanitize in _WRAP_KEYS:
+            if key not in polarion_data:
+                continue
             line = polarion_data[key]
 
             if not line or isinstance(line, list):
                 continue
 
-            if key not in pf.VALID_VALUES:
+            if needs_sanitize:
                 line = _sanitize_string(line)
             line = line.strip()
 
             # wrap line if too long
             if len(line) > 80:
-                line = textwrap.wrap(line, width=60)
+                line = _WRAPPER_60.wrap(line)
             elif '\n' in line:
                 line = line.replace('\n', ' ')
-                line = re.sub(' +', ' ', line)
+                line = _MULTI_SPACE_RE.sub(' ', line)
 
             polarion_data[key] = line
 
     def format_polarion_data(self, polarion_data):
         data_list = []
-        ommit_keys = {
-            'caseautomation',
-            'caselevel',
-            'description',
-            'testSteps',
-            'expectedResults',
-            'work_item_id',
-        }
 
         # "caseautomation" is not "automated" when it's present
-        if 'caseautomation' not in polarion_data:
-            for key in pf.MANUAL_ONLY_FIELDS:
-                ommit_keys.add(key)
+        if 'caseautomation' in polarion_data:
+            format_keys = _FORMAT_KEYS
+        else:
+            format_keys = _FORMAT_KEYS_AUTOMATED
 
         steps, results = self._get_formatted_steps(polarion_data)
         self._transform_polarion_data(polarion_data)
         self._wrap_values(polarion_data)
 
-        for key in sorted(set(polarion_data) - ommit_keys):
+        for key in format_keys:
+            if key not in polarion_data:
+                continue
             lines = polarion_data[key] or []
             first_line = None
             if lines:
@@ -231,12 +291,11 @@ class TestsTransform(object):
                     first_line = lines
                     lines = []
 
-            key_indent = (len(key) + 2) * ' '
-
             if first_line or key in pf.REQUIRED_FIELDS:
                 data_list.append('{}: {}'.format(key, first_line or None))
-            for val in lines:
-                data_list.append('{}{}'.format(key_indent, val))
+            if lines:
+                key_indent = (len(key) + 2) * ' '
+                data_list.extend(key_indent + val for val in lines)
 
         data_list.extend(steps)
         data_list.extend(results)
@@ -248,14 +307,24 @@ class TestsTransform(object):
         if not polarion_data:
             return ''
 
+        # docstring for tests without Polarion data differs only by indentation
+        if polarion_data is self.DEFAULT_DATA:
+            default_docstring = self._default_docstrings.get(indent)
+            if default_docstring is None:
+                default_docstring = self._gen_polarion_docstring(
+                    dict(self.DEFAULT_DATA), indent)
+                self._default_docstrings[indent] = default_docstring
+            return default_docstring
+
+        return self._gen_polarion_docstring(polarion_data, indent)
+
+    def _gen_polarion_docstring(self, polarion_data, indent):
         indent = indent * ' '
-        polarion_docstrings = []
-        polarion_docstrings.append('{}Polarion:'.format(indent))
-        pol_indent = '{}{}'.format(indent, 4 * ' ')
+        pol_indent = indent + 4 * ' '
+        polarion_docstrings = [indent + 'Polarion:']
 
         lines = self.format_polarion_data(polarion_data)
-        for line in lines:
-            polarion_docstrings.append('{}{}'.format(pol_indent, line))
+        polarion_docstrings.extend(pol_indent + line for line in lines)
         return '\n'.join(polarion_docstrings)
 
     def append_to_docstring(self, tests_info, polarion_data):
@@ -270,24 +339,24 @@ class TestsTransform(object):
         indent_str = indent * ' '
 
         if tests_info.docstring_data:
-            new_docstring = ''.join(tests_info.docstring_data)
+            docstring_parts = list(tests_info.docstring_data)
         else:
-            new_docstring = '{}"""'.format(indent_str)
+            docstring_parts = [indent_str, '"""']
 
         polarion_docstring = self.get_polarion_docstring(polarion_data, indent)
-        new_docstring = '{}\n{}\n{}"""\n'.format(new_docstring, polarion_docstring, indent_str)
-        return new_docstring
+        docstring_parts.extend(('\n', polarion_docstring, '\n', indent_str, '"""\n'))
+        return ''.join(docstring_parts)
 
     def process_testfile(self, pyinput, active_testcases, newfile):
         """Adds Polarion data to docstrings."""
         tiers_info = CurrentTier()
         tests_info = CurrentTest()
-        line = pyinput.readline()
         modified = False
         polarion_data = None
+        tier_annotation = None
         last_test = tests_info.test_name
 
-        while line:
+        for line in pyinput:
             modified_line = tiers_info.process_line(line)
             modified_line = tests_info.process_line(modified_line)
             if tests_info.line_is_in_docstring:
@@ -296,9 +365,14 @@ class TestsTransform(object):
                 last_test = tests_info.test_name
                 polarion_data = self.get_polarion_data(tests_info.test_name, active_testcases)
                 if polarion_data and 'caseautomation' in polarion_data:
-                    self.manual_tests_seen.append(tests_info.test_name)
+                    self.manual_tests_seen.add(tests_info.test_name)
+                tier_annotation = None
+                if polarion_data:
+                    tier_annotation = self.get_tier_annotation(polarion_data)
             if tiers_info.tier_missing and polarion_data:
-                modified_line = self.append_tier(polarion_data, modified_line)
+                # indentation of the test definition line was already found by `tiers_info`
+                modified_line = self.append_tier(
+                    tier_annotation, modified_line, tiers_info.method_indent)
                 modified = True
             if tests_info.docstring_end:
                 modified_line = '{}{}'.format(
@@ -308,28 +382,24 @@ class TestsTransform(object):
                 modified = True
 
             self._copy_string(modified_line, newfile)
-            line = pyinput.readline()
 
         return modified
 
 
+def _replace_markup(match):
+    markup = match.group(0)
+    if markup in _ENTITY_MAP:
+        return _ENTITY_MAP[markup]
+    # `<br>` is line break, any other tag is removed
+    return '\n' if match.group(1) is not None else ''
+
+
 def _sanitize_string(string):
-    cdata = re.search(r'<!\[CDATA\[(.+)\]\]>', string)
+    cdata = _CDATA_RE.search(string)
     if cdata:
         string = cdata.group(1)
-    string = re.sub('<br ?/?>', r'\n', string)
-    string = re.sub('<[^>]+>', '', string)
-    string = re.sub(' *\n', '\n', string)
-    string = (string
-              .replace('&npsp;', ' ')
-              .replace('&gt;', '>')
-              .replace('&lt;', '<')
-              .replace('&quot;', '"')
-              .replace('&amp;', '&')
-              .replace('&#39;', '"')
-              .replace('&#10;', '\n')
-              .replace(u'\xa0', u' '))
-    string = re.sub(r'(\n)+', r'\n', string)
+    string = _MARKUP_RE.sub(_replace_markup, string)
+    string = _NEWLINES_RE.sub('\n', string)
     return string
 
 
@@ -340,18 +410,19 @@ def _sanitize_paragraph(paragraph):
     if not new_paragraph:
         return None
 
-    desc_lines = new_paragraph.split('\n')
     new_lines = []
-    for line in desc_lines:
-        new_lines.extend(textwrap.wrap(line.strip()))
+    for line in new_paragraph.splitlines():
+        if line[:1].isspace() or line[-1:].isspace():
+            line = line.strip()
+        new_lines.extend(_WRAPPER.wrap(line))
     return new_lines
 
 
-def get_active_testcases(repo_dir):
+def get_active_testcases(repo_dir, jobs=1):
     """Gets active testcases in Polarion."""
     polarion_testcases = PolarionTestcases(repo_dir)
     try:
-        polarion_testcases.load_active_testcases()
+        polarion_testcases.load_active_testcases(jobs)
     except Exception as err:
         raise TestcasesException(
             'Failed to load testcases from SVN repo {}: {}'.format(repo_dir, err))
@@ -366,8 +437,8 @@ def get_test_files():
     """Finds all test files."""
     for root, __, files in os.walk('./cfme/tests/'):
         for _file in files:
-            if '.py' in _file and 'test_' in _file:
-                yield '{}/{}'.format(root, _file)
+            if _file.startswith('test_') and _file.endswith('.py'):
+                yield os.path.join(root, _file)
 
 
 def overwrite_file(pyfile, string):
@@ -376,29 +447,58 @@ def overwrite_file(pyfile, string):
         return
     with io.open(pyfile, 'w', encoding='utf-8') as pyout:
         pyout.write(string)
-        pyout.truncate()
 
 
-def gen_modified_content(pyfile, active_testcases, tests_transform):
-    """Generates the modified test file."""
-    newfile = []
-    modified = False
+def update_test_file(pyfile, active_testcases, tests_transform):
+    """Writes the modified test file to a temporary file and replaces the original with it."""
+    tmp_fd, tmp_path = tempfile.mkstemp(
+        prefix='.{}.'.format(os.path.basename(pyfile)), dir=os.path.dirname(pyfile))
+    try:
+        with io.open(tmp_fd, 'w', encoding='utf-8') as newfile, \
+                io.open(pyfile, encoding='utf-8', buffering=65536) as pyinput:
+            modified = tests_transform.process_testfile(pyinput, active_testcases, newfile)
+        if not modified:
+            return False
+        shutil.copymode(pyfile, tmp_path)
+        os.rename(tmp_path, pyfile)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return True
+
+
+# data shared by all files processed in a worker process, set by `_init_worker`
+_WORKER_STATE = {}
 
-    with io.open(pyfile, encoding='utf-8') as pyinput:
-        modified = tests_transform.process_testfile(pyinput, active_testcases, newfile)
 
-    if modified:
-        newfile_str = ''.join(newfile)
-        return newfile_str
-    return None
+def _init_worker(active_testcases):
+    _WORKER_STATE['active_testcases'] = active_testcases
+    _WORKER_STATE['tests_transform'] = TestsTransform()
 
 
-def get_requirements_db():
-    req_db = {}
-    for req_name, req_ids in REQUIREMENTS_MAP.items():
-        for req_id in req_ids:
-            req_db[req_id] = req_name
-    return req_db
+def _update_test_file_worker(pyfile):
+    """Updates test file in worker process, returns names of manual tests seen in it."""
+    tests_transform = _WORKER_STATE['tests_transform']
+    tests_transform.manual_tests_seen = set()
+    update_test_file(pyfile, _WORKER_STATE['active_testcases'], tests_transform)
+    return tests_transform.manual_tests_seen
+
+
+def update_test_files_parallel(test_files, active_testcases, tests_transform, jobs):
+    """Updates test files using pool of worker processes."""
+    chunksize = max(1, len(test_files) // (4 * jobs))
+    pool = multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(active_testcases,))
+    try:
+        for manual_tests_seen in pool.imap_unordered(
+                _update_test_file_worker, test_files, chunksize):
+            tests_transform.manual_tests_seen.update(manual_tests_seen)
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
 
 
 def get_requirement_annotation(polarion_data, req_db):
@@ -430,23 +530,12 @@ def add_manual_test(test_name, polarion_data, tests_transform, req_db):
     indent = 4 * ' '
 
     new_test_name = polarion_data.get('title') or test_name
-    new_test_name = (new_test_name
-                     .replace(' ', '_')
-                     .replace(':', '_')
-                     .replace('/', '_')
-                     .replace('-', '_')
-                     .replace('(', '_')
-                     .replace(')', '_')
-                     .replace('[', '_')
-                     .replace(']', '_')
-                     .strip()
-                     .strip('_')
-                     .lower())
-    new_test_name = re.sub('_+', '_', new_test_name)
-    new_test_name = re.sub('[^a-z0-9_]', '', new_test_name)
+    # punctuation is replaced and runs of underscores are collapsed in the same pass
+    new_test_name = _TITLE_PUNCT_RE.sub('_', new_test_name).strip().strip('_').lower()
+    new_test_name = _NON_ALNUM_RE.sub('', new_test_name)
     new_test_name = new_test_name[:85]
-    if 'test_' not in new_test_name:
-        new_test_name = 'test_{}'.format(new_test_name)
+    if not new_test_name.startswith('test_'):
+        new_test_name = 'test_' + new_test_name
 
     req_annotation = get_requirement_annotation(polarion_data, req_db)
     if req_annotation:
@@ -454,10 +543,10 @@ def add_manual_test(test_name, polarion_data, tests_transform, req_db):
     tier_annotation = tests_transform.get_tier_annotation(polarion_data)
     if tier_annotation:
         lines.append(tier_annotation)
-    lines.append('def {}():'.format(new_test_name))
+    lines.append('def ' + new_test_name + '():')
 
     description = polarion_data.get('description') or []
-    new_description = ['{}{}'.format(indent, line) for line in description if line]
+    new_description = [indent + line for line in description if line]
     if new_description:
         new_description.append('\n')
         new_description = '\n'.join(new_description)
@@ -483,11 +572,11 @@ def sanitize_description(polarion_data):
         del polarion_data['description']
 
 
-def _get_manual_polarion_data(testcase_name, active_testcases, tests_transform):
+def _get_manual_polarion_data(testcase_ids, active_testcases, tests_transform):
     multi_polarion_data = []
-    for testcase_id in active_testcases.available_testcases[testcase_name]:
-        testcase_data = active_testcases.wi_cache[testcase_id] or {}
-        if testcase_data.get('caseautomation') != 'automated':
+    for testcase_id in testcase_ids:
+        testcase_data = active_testcases.wi_cache[testcase_id]
+        if testcase_data:
             multi_polarion_data.append(tests_transform.filter_testcase_fields(testcase_data))
     return multi_polarion_data
 
@@ -495,21 +584,21 @@ def _get_manual_polarion_data(testcase_name, active_testcases, tests_transform):
 def gen_manual_testcases(active_testcases, tests_transform):
     all_lines = manual_tests_header()
     manual_testcases = active_testcases.get_manual_testcases()
-    to_process = set(manual_testcases) - set(tests_transform.manual_tests_seen)
+    to_process = set(manual_testcases) - tests_transform.manual_tests_seen
     if not to_process:
         return all_lines
 
-    req_db = get_requirements_db()
-
     for test_name in to_process:
+        # IDs of testcases that are not automated were already collected
         multi_polarion_data = _get_manual_polarion_data(
-            test_name, active_testcases, tests_transform)
+            manual_testcases[test_name], active_testcases, tests_transform)
         if not multi_polarion_data:
             logger.error('Failed to get data for test `%s`', test_name)
             continue
         for polarion_data in multi_polarion_data:
             sanitize_description(polarion_data)
-            test_lines = add_manual_test(test_name, polarion_data, tests_transform, req_db)
+            test_lines = add_manual_test(
+                test_name, polarion_data, tests_transform, _REQUIREMENTS_DB)
             all_lines.extend(test_lines)
 
     return all_lines
@@ -522,6 +611,9 @@ def get_args(args=None):
                         help='Path to SVN repo with Polarion project')
     parser.add_argument('--log-level',
                         help='Set logging to specified level')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of parallel jobs for loading testcases and updating '
+                             'test files (default: 1)')
     return parser.parse_args(args)
 
 
@@ -543,12 +635,15 @@ def main(args=None):
     except OSError:
         pass
 
-    active_testcases = get_active_testcases(args.repo_dir)
+    active_testcases = get_active_testcases(args.repo_dir, args.jobs)
     tests_transform = TestsTransform()
 
-    for test_file in get_test_files():
-        new_content = gen_modified_content(test_file, active_testcases, tests_transform)
-        overwrite_file(test_file, new_content)
+    test_files = list(get_test_files())
+    if args.jobs > 1:
+        update_test_files_parallel(test_files, active_testcases, tests_transform, args.jobs)
+    else:
+        for test_file in test_files:
+            update_test_file(test_file, active_testcases, tests_transform)
 
     manual_tests_lines = gen_manual_testcases(active_testcases, tests_transform)
     manual_tests = '{}\n'.format('\n'.join(manual_tests_lines).rstrip())
@@ -5,7 +5,7 @@ import logging
 import os
 import re
 
-from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 
 from lxml import etree
 
@@ -14,6 +14,11 @@ from lxml import etree
 logger = logging.getLogger(__name__)
 
 
+_STEPS_XPATH = etree.XPath('.//item[@id = "steps"]')
+_STEP_ITEMS_XPATH = etree.XPath('.//item[@text-type]')
+_LINKED_ITEMS_XPATH = etree.XPath('./list/struct')
+
+
 # pylint: disable=too-few-public-methods
 class InvalidObject(object):
     """Item not present or it's not testcase."""
@@ -25,7 +30,7 @@ class WorkItemCache(object):
     def __init__(self, repo_dir):
         self.repo_dir = repo_dir
         self.test_case_dir = os.path.join(self.repo_dir, 'tracker/workitems/')
-        self._cache = defaultdict(dict)
+        self._cache = {}
 
     @staticmethod
     def get_path(num):
@@ -38,12 +43,12 @@ class WorkItemCache(object):
         paths = []
         for i in range(dig_len - 2):
             divisor = 10 ** (dig_len - i - 1)
-            paths.append(
-                '{}-{}'.format((num / divisor) * divisor, (((num / divisor) + 1) * divisor) - 1))
+            start = (num // divisor) * divisor
+            paths.append('{}-{}'.format(start, start + divisor - 1))
         return '/'.join(paths)
 
-    def get_tree(self, work_item_id):
-        """Gets XML tree of the workitem."""
+    def get_xml_path(self, work_item_id):
+        """Gets path to XML file of the workitem."""
         try:
             __, tcid = work_item_id.split('-')
         except ValueError:
@@ -51,28 +56,20 @@ class WorkItemCache(object):
             self._cache[work_item_id] = InvalidObject()
             return None
 
-        path = os.path.join(
+        return os.path.join(
             self.test_case_dir, self.get_path(tcid), work_item_id, 'workitem.xml')
-        try:
-            tree = etree.parse(path)
-        # pylint: disable=broad-except
-        except Exception:
-            logger.warning('Couldn\'t load workitem %s', work_item_id)
-            self._cache[work_item_id] = InvalidObject()
-            return None
-        return tree
 
     @staticmethod
     def _get_steps(item):
         steps = []
         expected_results = []
 
-        steps_list = item.xpath('.//item[@id = "steps"]')
+        steps_list = _STEPS_XPATH(item)
         if not steps_list:
             return steps, expected_results
 
         steps_list = steps_list[0]
-        steps_items = steps_list.xpath('.//item[@text-type]')
+        steps_items = _STEP_ITEMS_XPATH(steps_list)
         for index, rec in enumerate(steps_items):
             if index % 2:
                 expected_results.append(rec.text)
@@ -83,7 +80,7 @@ class WorkItemCache(object):
     @staticmethod
     def _get_linked_items(item):
         linked = []
-        linked_items = item.xpath('./list/struct')
+        linked_items = _LINKED_ITEMS_XPATH(item)
         for struct in linked_items:
             role_found = False
             struct_item = None
@@ -103,38 +100,62 @@ class WorkItemCache(object):
 
         return linked
 
-    def __getitem__(self, work_item_id):
-        if work_item_id in self._cache:
-            return self._cache[work_item_id]
-        elif isinstance(self._cache[work_item_id], InvalidObject):
-            return None
-
-        tree = self.get_tree(work_item_id)
-        if not tree:
-            return None
+    def _parse_fields(self, xml_path):
+        """Parses fields of the workitem without keeping the whole XML tree in memory."""
+        work_item = {}
+        for __, item in etree.iterparse(xml_path, events=('end',), tag='field'):
+            parent = item.getparent()
+            if parent.tag != 'work-item':
+                continue
 
-        for item in tree.xpath('/work-item/field'):
             attrib = item.attrib['id']
             if attrib == 'testSteps':
                 steps, results = self._get_steps(item)
-                self._cache[work_item_id]['testSteps'] = steps
-                self._cache[work_item_id]['expectedResults'] = results
+                work_item['testSteps'] = steps
+                work_item['expectedResults'] = results
             elif attrib == 'linkedWorkItems':
-                self._cache[work_item_id]['linkedWorkItems'] = self._get_linked_items(item)
+                work_item['linkedWorkItems'] = self._get_linked_items(item)
             else:
-                self._cache[work_item_id][item.attrib['id']] = item.text
+                work_item[attrib] = item.text
+
+            # free the already processed fields
+            item.clear()
+            while item.getprevious() is not None:
+                del parent[0]
+
+        return work_item
+
+    def __getitem__(self, work_item_id):
+        cached = self._cache.get(work_item_id)
+        if isinstance(cached, InvalidObject):
+            return None
+        elif cached is not None:
+            return cached
+
+        xml_path = self.get_xml_path(work_item_id)
+        if not xml_path:
+            return None
+
+        try:
+            work_item = self._parse_fields(xml_path)
+        # pylint: disable=broad-except
+        except Exception:
+            logger.warning('Couldn\'t load workitem %s', work_item_id)
+            self._cache[work_item_id] = InvalidObject()
+            return None
 
-        if self._cache[work_item_id]['type'] != 'testcase':
+        if work_item.get('type') != 'testcase':
             self._cache[work_item_id] = InvalidObject()
             return None
 
-        self._cache[work_item_id]['work_item_id'] = work_item_id
-        if 'assignee' not in self._cache[work_item_id]:
-            self._cache[work_item_id]['assignee'] = ''
-        if 'title' not in self._cache[work_item_id]:
+        work_item['work_item_id'] = work_item_id
+        if 'assignee' not in work_item:
+            work_item['assignee'] = ''
+        if 'title' not in work_item:
             logger.debug('Workitem %s has no title', work_item_id)
 
-        return self._cache[work_item_id]
+        self._cache[work_item_id] = work_item
+        return work_item
 
 
 class PolarionTestcases(object):
@@ -147,16 +168,33 @@ class PolarionTestcases(object):
         self.wi_cache = WorkItemCache(self.repo_dir)
         self.available_testcases = {}
 
-    def load_active_testcases(self):
+    def _load_workitems(self, case_ids, jobs):
+        """Loads workitems into cache, returns list of loaded workitems."""
+        if jobs <= 1:
+            return [self.wi_cache[case_id] for case_id in case_ids]
+
+        # lxml releases GIL while parsing, so XML files can be parsed by several threads
+        pool = ThreadPool(jobs)
+        try:
+            return pool.map(self.wi_cache.__getitem__, case_ids)
+        finally:
+            pool.close()
+            pool.join()
+
+    def load_active_testcases(self, jobs=1):
         """Creates dict of all active testcase's names and ids."""
-        cases = {}
-        for item in os.walk(self.wi_cache.test_case_dir):
-            if 'workitem.xml' not in item[2]:
-                continue
-            case_id = os.path.split(item[0])[-1]
-            if not (case_id and '*' not in case_id):
+        case_ids = []
+        for root, dirs, files in os.walk(self.wi_cache.test_case_dir):
+            if 'workitem.xml' not in files:
                 continue
-            item_cache = self.wi_cache[case_id]
+            # no need to descend into subdirectories of workitem (comments, attachments, etc.)
+            dirs[:] = []
+            case_id = os.path.split(root)[-1]
+            if case_id and '*' not in case_id:
+                case_ids.append(case_id)
+
+        cases = {}
+        for case_id, item_cache in zip(case_ids, self._load_workitems(case_ids, jobs)):
             if not item_cache:
                 continue
             case_status = item_cache.get('status')
@@ -196,6 +234,17 @@ class PolarionTestcases(object):
                     manual_testcases[case_title] = [case_id]
         return manual_testcases
 
+    def get_automated_testcases(self):
+        """Gets first automated testcase for each testcase name."""
+        automated_testcases = {}
+        for case_title, case_ids in self.available_testcases.items():
+            for case_id in case_ids:
+                case = self.wi_cache[case_id]
+                if case.get('caseautomation') == 'automated':
+                    automated_testcases[case_title] = case
+                    break
+        return automated_testcases
+
     @staticmethod
     def _check_automation(case, should_be_automated):
         caseautomation = case.get('caseautomation')
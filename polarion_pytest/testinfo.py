@@ -10,25 +10,37 @@ class CurrentTier(object):
     TIER_MOD = re.compile(r'pytest.mark.tier\(([1-3])\)')
     TIER_DEC = re.compile(r'@pytest.mark.tier\(([1-3])\)')
 
+    # instances process every line of every test file, slots make attribute access cheaper
+    __slots__ = (
+        'tier_missing',
+        '_module',
+        '_class',
+        '_method',
+        'method_indent',
+        '_tier_pending',
+    )
+
     def __init__(self):
         self.tier_missing = False
         self._module = None
         self._class = None
         self._method = None
-        self._method_indent = 0
+        self.method_indent = 0
         self._tier_pending = None
 
     def process_line(self, line):
         """Sets correct tier if found."""
         self.tier_missing = False
-        tier_found = self.TIER_DEC.search(line)
-        if tier_found:
-            self._tier_pending = tier_found.group(1)
-            return line
-        tier_found = self.TIER_MOD.search(line)
-        if tier_found:
-            self._module = tier_found.group(1)
-            return line
+        # cheap check first, most lines don't contain tier marker
+        if 'tier(' in line:
+            tier_found = self.TIER_DEC.search(line)
+            if tier_found:
+                self._tier_pending = tier_found.group(1)
+                return line
+            tier_found = self.TIER_MOD.search(line)
+            if tier_found:
+                self._module = tier_found.group(1)
+                return line
 
         if 'class Test' in line:
             self._class = None
@@ -40,8 +52,8 @@ class CurrentTier(object):
             if self._tier_pending:
                 self._method = self._tier_pending
                 self._tier_pending = None
-            self._method_indent = len(line) - len(line.lstrip(' '))
-            if self._method_indent == 0:
+            self.method_indent = len(line) - len(line.lstrip(' '))
+            if self.method_indent == 0:
                 self._class = None
             if not (self._method or self._class or self._module):
                 self.tier_missing = True
@@ -57,6 +69,18 @@ class CurrentTest(object):
     DOCSTRING_SAME_END = re.compile(r' *[^ ].+""" *$')
     DOCSTRING_END = re.compile(r' *""" *$')
 
+    __slots__ = (
+        'test_class',
+        'test_name',
+        'docstring_data',
+        'docstring_begin',
+        'docstring_end',
+        'line_is_in_docstring',
+        '_test_def_now',
+        '_docstring_next',
+        '_docstring_now',
+    )
+
     def __init__(self):
         self.test_class = None
         self.test_name = None
@@ -131,6 +155,10 @@ class CurrentTest(object):
             self.line_is_in_docstring = True
             self._docstring_now = True
             self.docstring_data.append(line)
+        elif self._docstring_now and '"""' not in line:
+            # cheap check first, line without quotes can't end the docstring
+            self.line_is_in_docstring = True
+            self.docstring_data.append(line)
         elif self._docstring_now and self.DOCSTRING_SAME_END.match(line):
             self._handle_same_line_end(line)
         elif self._docstring_now and self.DOCSTRING_END.match(line):